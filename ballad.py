@@ -3,8 +3,10 @@ import sys
 import oisin
 
 filename = "input/alices.txt"
+checkpoint = None
 try:
     filename = sys.argv[1]
+    checkpoint = sys.argv[2]
 except IndexError:
     pass
 
@@ -12,4 +14,5 @@ oisin.balladize(
     oisin.load(filename),
     meter=oisin.iambic(4, 'aabbccdd'),
     step=50,
-    order=3)
+    order=3,
+    checkpoint=checkpoint)
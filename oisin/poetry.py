@@ -1,4 +1,9 @@
 from collections import defaultdict, namedtuple
+import gzip
+import hashlib
+import os
+import pickle
+import random
 import re
 import pronouncing
 
@@ -109,6 +114,150 @@ def wordseqs(sent, length):
     return subseqs(sylls, length, [('*', i) for i in range(length)])
 
 
+PREFIX, SUFFIX, RHYME, NONRHYME = range(4)
+
+# The metrical requirements a node places on its state
+Slot = namedtuple("Slot", "first linestart stress noend end")
+
+# The metrical properties of one syllable of a state; end is None when the
+# state does not say whether the sentence finishes after that syllable
+Signature = namedtuple("Signature",
+                       "start linestart stressed unstressed end")
+
+
+def fits(slot, sig):
+    """Whether a syllable with signature sig can ever fill slot"""
+    if slot.first and not sig.start:
+        return False
+    if slot.linestart and not sig.linestart:
+        return False
+    if slot.stress == '-' and not sig.stressed:
+        return False
+    if slot.stress == '.' and not sig.unstressed:
+        return False
+    if slot.noend and sig.end:
+        return False
+    if slot.end and sig.end is False:
+        return False
+    return True
+
+
+def signature(state, starts):
+    """Get the signatures of the syllables a state commits to.
+
+    A state is a window onto its sentence, so besides its own syllable it
+    fixes the syllables of the next few nodes, up to the end of the sentence.
+    """
+    sig = []
+    for i, (word, syll) in enumerate(state):
+        if word == '*':
+            break
+        if i + 1 < len(state):
+            end = state[i + 1] == ('*', 0)
+        else:
+            end = None
+        sig.append(Signature(
+            start=i == 0 and state in starts,
+            linestart=syll == 0,
+            stressed=stressed(word, syll),
+            unstressed=unstressed(word, syll),
+            end=end))
+    return tuple(sig)
+
+
+class FormTopology(object):
+    """The node graph of a poetic form, independent of any corpus.
+
+    Each node is one syllable of the poem. Every arc from a node to a
+    neighbour carries a kind and an offset, so that constraint lookups can
+    dispatch on it without recomputing positions.
+    """
+
+    def __init__(self, scheme, length):
+        self.scheme = scheme
+        self.length = length
+        self.nodes = range(sum(line.syllcount for line in scheme))
+
+        breaks = [0]
+        for line in scheme:
+            breaks.append(breaks[-1] + line.syllcount)
+        self.breaks = breaks[1:]
+
+        rhymesets = defaultdict(list)
+        for line, end in zip(scheme, self.breaks):
+            rhymesets[line.rhyme].append(end - 1)
+        self.rhymes = {}
+        for rs in rhymesets.values():
+            for s in rs:
+                self.rhymes[s] = tuple(x for x in rs if x != s)
+
+        last = len(self.nodes) - 1
+        self.arcs = []
+        self.neighbours = []
+        for node in self.nodes:
+            arcs = {}
+            for nb in range(max(node - length + 1, 0),
+                            min(node + length, last + 1)):
+                if nb < node:
+                    arcs[nb] = (PREFIX, node - nb)
+                elif nb > node:
+                    arcs[nb] = (SUFFIX, nb - node)
+            if node in self.rhymes:
+                for nb in self.rhymes:
+                    if nb == node or nb in arcs:
+                        continue
+                    if nb in self.rhymes[node]:
+                        arcs[nb] = (RHYME, 0)
+                    else:
+                        arcs[nb] = (NONRHYME, 0)
+            self.arcs.append(arcs)
+            self.neighbours.append(tuple(sorted(arcs)))
+
+        self.slots = []
+        for line, end in zip(scheme, self.breaks):
+            linelength = line.syllcount
+            for linepos in range(linelength):
+                pos = linepos
+                for foot in line.feet:
+                    if pos >= len(foot):
+                        pos -= len(foot)
+                    else:
+                        break
+                self.slots.append(Slot(
+                    first=not self.slots,
+                    linestart=linepos == 0,
+                    stress=foot[pos],
+                    noend=linepos in [0, 1, linelength - 3, linelength - 2],
+                    end=end - 1 == last and linepos == linelength - 1))
+        self.placements = {}
+
+    def place(self, sig):
+        """Get the nodes at which a state with signature sig could sit"""
+        try:
+            return self.placements[sig]
+        except KeyError:
+            pass
+        last = len(self.nodes) - 1
+        nodes = frozenset(
+            node for node in self.nodes
+            if node + len(sig) - 1 <= last and all(
+                fits(self.slots[node + i], s) for i, s in enumerate(sig)))
+        self.placements[sig] = nodes
+        return nodes
+
+
+def topology(scheme, length, cache={}):
+    """Get the (shared) FormTopology for a scheme and Markov order"""
+    key = (tuple((tuple(line.feet), line.rhyme) for line in scheme), length)
+    try:
+        return cache[key]
+    except KeyError:
+        pass
+    result = FormTopology(scheme, length)
+    cache[key] = result
+    return result
+
+
 class PoemCollapser(wfc.Collapser):
     def __init__(self, corpus, scheme, length=3):
         self.scheme = scheme
@@ -129,7 +278,12 @@ class PoemCollapser(wfc.Collapser):
             self.ends.add(seqs[-length])
             for state in seqs:
                 self.statepos[state].append((i + 1.) / (n + 2.))
-        nodes = range(sum(line.syllcount for line in scheme))
+        self.topology = topology(scheme, length)
+        nodes = self.topology.nodes
+
+        allstates = states
+        states = self.prefilter(states)
+        self.starts &= states
 
         self.prefix = defaultdict(set)
         self.suffix = defaultdict(set)
@@ -151,23 +305,13 @@ class PoemCollapser(wfc.Collapser):
                 self.prefix[tuple(('*', j) for j in range(i))].add(s)
                 for e in self.ends:
                     suf = e[-i:] + tuple(('*', j) for j in range(length - i))
-                    assert suf in states, (i, e, suf)
+                    assert suf in allstates, (i, e, suf)
+                    if suf not in states:
+                        continue
                     self.suffix[s[:length - i]].add(suf)
 
-        breaks = [0]
-        for line in scheme:
-            breaks.append(breaks[-1] + line.syllcount)
-        self.breaks = breaks[1:]
-
-        rhymesets = defaultdict(list)
-        syll = -1
-        for line in scheme:
-            syll += line.syllcount
-            rhymesets[line.rhyme].append(syll)
-        self.rhymes = defaultdict(list)
-        for rs in rhymesets.values():
-            for s in rs:
-                self.rhymes[s] = [x for x in rs if x != s]
+        self.breaks = self.topology.breaks
+        self.rhymes = self.topology.rhymes
 
         self.rhymeswith = defaultdict(set)
         for s in states:
@@ -177,69 +321,33 @@ class PoemCollapser(wfc.Collapser):
         wfc.Collapser.__init__(self, nodes, states)
 
     def neighbours(self, node):
-        nbs = [
-            x for x in range(node - self.length + 1, node + self.length)
-            if x != node and 0 <= x <= self.nodes[-1]
-        ]
-        if node in self.rhymes:
-            nbs += [n for n in self.rhymes if n != node]
-        return nbs
+        return self.topology.neighbours[node]
 
     def consistent(self, node, nb, s):
-        if node == nb:
-            return wfc.anything
-        if abs(node - nb) > self.length:
-            rhymepart = rhyme(s[0][0])
-            if node in self.rhymes[nb]:
-                return set(x for x in self.rhymeswith[rhymepart]
-                           if not x[0][0].endswith(
-                               s[0][0]) and not s[0][0].endswith(x[0][0]))
-            else:
-                return wfc.Except(self.rhymeswith[rhymepart])
-        elif node > nb:
-            n = node - nb
-            return self.prefix[s[n:]]
-        elif node < nb:
-            n = nb - node
-            return self.suffix[s[:-n]]
+        kind, offset = self.topology.arcs[node][nb]
+        if kind == PREFIX:
+            return self.prefix[s[offset:]]
+        elif kind == SUFFIX:
+            return self.suffix[s[:-offset]]
+        rhymepart = rhyme(s[0][0])
+        if kind == RHYME:
+            return set(x for x in self.rhymeswith[rhymepart]
+                       if not x[0][0].endswith(s[0][0])
+                       and not s[0][0].endswith(x[0][0]))
+        else:
+            return wfc.Except(self.rhymeswith[rhymepart])
+
+    def prefilter(self, states):
+        """Drop states which no node of the form could ever accept"""
+        self.placements = {}
+        for s in states:
+            nodes = self.topology.place(signature(s, self.starts))
+            if nodes:
+                self.placements[s] = nodes
+        return set(self.placements)
 
     def restrict(self, node):
-        states = self.states
-        if node == 0:
-            states = self.starts
-        sylls = 0
-        for line in self.scheme:
-            if node == sylls:
-                states = set([s for s in states if s[0][1] == 0])
-            sylls += line.syllcount
-        pos = node
-        for line in self.scheme:
-            if pos >= line.syllcount:
-                pos -= line.syllcount
-            else:
-                break
-        linepos = pos
-        linelength = line.syllcount
-        # iambic
-        for foot in line.feet:
-            if pos >= len(foot):
-                pos -= len(foot)
-            else:
-                break
-        try:
-            if foot[pos] == '-':
-                states = set([s for s in states if stressed(*s[0])])
-            elif foot[pos] == '.':
-                states = set([s for s in states if unstressed(*s[0])])
-        except:
-            print(pos, foot)
-            raise
-
-        if linepos in [0, 1, linelength - 3, linelength - 2]:
-            states = set([s for s in states if s[1] != ('*', 0)])
-        if node == self.nodes[-1]:
-            states = set([s for s in states if s[1] == ('*', 0)])
-
+        states = set(s for s in self.states if node in self.placements[s])
         if states != self.states:
             return states
 
@@ -322,30 +430,94 @@ verse = iambic(5, 'abcb')
 blank = iambic(5, 'abcd')
 
 
-def balladize(tokens, meter=ballad, step=10, refrain=None, order=3):
+def save_checkpoint(filename, run, start, end, stanzas, tries=0, pc=None):
+    """Atomically and durably write the progress of a balladize run"""
+    state = {
+        "run": run,
+        "start": start,
+        "end": end,
+        "stanzas": stanzas,
+        "random": random.getstate(),
+        "tries": tries,
+        "collapser": pc.snapshot() if pc is not None else None
+    }
+    tmp = filename + ".tmp"
+    with open(tmp, "wb") as raw:
+        with gzip.GzipFile(fileobj=raw, mode="wb") as f:
+            pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+        raw.flush()
+        os.fsync(raw.fileno())
+    os.replace(tmp, filename)
+    if os.name == "posix":
+        fd = os.open(os.path.dirname(os.path.abspath(filename)), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def load_checkpoint(filename, run):
+    """Read a checkpoint written by save_checkpoint for the same run"""
+    with gzip.open(filename, "rb") as f:
+        state = pickle.load(f)
+    if state["run"] != run:
+        raise ValueError("Checkpoint %s is for a different run" % filename)
+    random.setstate(state["random"])
+    return state
+
+
+def balladize(tokens, meter=ballad, step=10, refrain=None, order=3,
+              checkpoint=None, every=10):
+    corpus = '\n'.join(' '.join(sent) for sent in tokens)
+    digest = hashlib.sha1(corpus.encode('utf-8')).hexdigest()
+    run = (digest, meter, step, refrain, order)
     start = 0
     end = step
     stanzas = []
+    resume = None
+    if checkpoint is not None and os.path.exists(checkpoint):
+        resume = load_checkpoint(checkpoint, run)
+        start, end = resume["start"], resume["end"]
+        stanzas = resume["stanzas"]
+        for i, stanza in enumerate(stanzas):
+            print("Checkpoint: stanza %d" % (i + 1))
+            print(stanza)
+            print()
+        if resume["collapser"] is None:
+            resume = None
     while end < len(tokens):
         while end < len(tokens):
             try:
                 sents = tokens[start:end]
                 if refrain:
                     sents.append(refrain)
+                saved, resume = resume, None
                 pc = PoemCollapser(sents, meter, order)
-                if refrain:
-                    refstates = wordseqs(refrain, order)
-                    for i in range(len(refstates)):
-                        pc.observe(pc.nodes[-(i + 1)], refstates[-(i + 1)])
-                    pc.propagate()
-                tries = 0
+                if saved is not None:
+                    tries = saved["tries"]
+                    pc.restore(saved["collapser"])
+                else:
+                    tries = 0
+                    if refrain:
+                        refstates = wordseqs(refrain, order)
+                        for i in range(len(refstates)):
+                            if refstates[-(i + 1)] not in pc.states:
+                                raise wfc.InconsistencyError
+                            pc.observe(pc.nodes[-(i + 1)],
+                                       refstates[-(i + 1)])
+                        pc.propagate()
                 while not pc.resolved() and tries < 40:
                     pc.step()
                     tries += 1
+                    if checkpoint is not None and tries % every == 0:
+                        save_checkpoint(checkpoint, run, start, end, stanzas,
+                                        tries, pc)
                 if tries >= 40:
                     raise wfc.InconsistencyError
             except wfc.InconsistencyError:
                 end += step
+                if checkpoint is not None:
+                    save_checkpoint(checkpoint, run, start, end, stanzas)
                 continue
             stanza = '\n'.join([' '.join(line) for line in pc.sample()])
             print("Sentences %d-%d: stanza %d" %
@@ -355,6 +527,8 @@ def balladize(tokens, meter=ballad, step=10, refrain=None, order=3):
             stanzas.append(stanza)
             start = end
             end = start + step
+            if checkpoint is not None:
+                save_checkpoint(checkpoint, run, start, end, stanzas)
     return stanzas
 
 
@@ -116,6 +116,15 @@ class Collapser(object):
                 return False
         return True
 
+    def snapshot(self):
+        """Get the progress of the collapse, for passing to restore"""
+        return self.valid, self.oldvalids
+
+    def restore(self, snapshot):
+        """Resume a collapse from a snapshot taken between steps"""
+        self.valid, self.oldvalids = snapshot
+        self.dirty = {}
+
     def report_valid(self):
         print([(node, len(self.valid[node])) for node in self.nodes])
 